@@ -17,12 +17,17 @@
 """
 
 import asyncio
+import bisect
 import html
 import json
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import os
+import re
 import tempfile
+import time
 from dataclasses import dataclass, field
-from io import BytesIO
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timezone
@@ -48,23 +53,76 @@ from dotenv import load_dotenv
 
 # ----------------------------- ХРАНИЛИЩЕ ----------------------------- #
 
+# Быстрый JSON для горячих путей (storage.json пишется на каждое действие):
+# orjson (Rust, в разы быстрее stdlib) -> ujson -> stdlib json как запасной вариант.
+try:
+    import orjson as _orjson
+
+    def _json_dumps(data: dict) -> bytes:
+        return _orjson.dumps(data, option=_orjson.OPT_NON_STR_KEYS)
+
+    def _json_loads(raw: bytes) -> dict:
+        return _orjson.loads(raw)
+
+    def _json_dumps_pretty(data: dict) -> bytes:
+        # для экспорта шаблонов: файл читают люди, оставляем отступы
+        return _orjson.dumps(data, option=_orjson.OPT_INDENT_2 | _orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    _orjson = None
+    try:
+        import ujson as _ujson
+
+        def _json_dumps(data: dict) -> bytes:
+            # без indent: storage.json читает только машина, pretty-print
+            # удваивает и время кодирования, и объём записи
+            return _ujson.dumps(data, ensure_ascii=False).encode("utf-8")
+
+        def _json_loads(raw: bytes) -> dict:
+            return _ujson.loads(raw)
+
+        def _json_dumps_pretty(data: dict) -> bytes:
+            return _ujson.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    except ImportError:
+        def _json_dumps(data: dict) -> bytes:
+            return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+        def _json_loads(raw: bytes) -> dict:
+            return json.loads(raw)
+
+        def _json_dumps_pretty(data: dict) -> bytes:
+            return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
 BASE_DIR = Path(os.getenv("DATA_DIR") or Path(__file__).resolve().parent)
 BASE_DIR.mkdir(parents=True, exist_ok=True)
 STORAGE_FILE = BASE_DIR / "storage.json"
+JOURNAL_FILE = BASE_DIR / "storage.journal.jsonl"
 AUDIT_FILE   = BASE_DIR / "audit.log"
 
 DEFAULT_STORAGE = {
     "admins": [],           # [user_id]
-    "channels": {},         # {str(user_id): channel_id}
-    "channel_titles": {},   # {str(user_id): "Title (id)"}
+    # id и заголовок всегда читаются/пишутся парой, поэтому лежат одной
+    # записью: {str(user_id): {"id": channel_id, "title": "Title (id)"}}
+    "channel_by_user": {},
     # Новый формат: "templates" -> {str(user_id): {game: {cheat: {name: {text, photo, buttons}}}}}
     "templates": {}
 }
 
+def _migrate_channel_pair(data: dict) -> None:
+    """Старый формат хранил канал в двух параллельных словарях
+    ("channels" и "channel_titles"); склеиваем их в "channel_by_user"."""
+    old_ids = data.pop("channels", None)
+    old_titles = data.pop("channel_titles", None)
+    if not old_ids:
+        return
+    merged = data.setdefault("channel_by_user", {})
+    titles = old_titles or {}
+    for key, ch_id in old_ids.items():
+        merged.setdefault(key, {"id": ch_id, "title": titles.get(key) or f"Канал ({ch_id})"})
+
 def load_storage() -> dict:
     if STORAGE_FILE.exists():
         try:
-            data = json.loads(STORAGE_FILE.read_text(encoding="utf-8"))
+            data = _json_loads(STORAGE_FILE.read_bytes())
             if not isinstance(data, dict):
                 data = {}
         except Exception:
@@ -72,20 +130,52 @@ def load_storage() -> dict:
     else:
         data = {}
 
+    _migrate_channel_pair(data)
     for k, v in DEFAULT_STORAGE.items():
         if k not in data:
             data[k] = v if not isinstance(v, (dict, list)) else ({} if isinstance(v, dict) else [])
+    _replay_journal(data)
+    _intify_user_keys(data)
     return data
 
-def save_storage(data: dict) -> None:
-    """Атомная запись, чтобы не бить файл при сбоях."""
+def _intify_user_keys(data: dict) -> None:
+    """JSON хранит user_id строками, в памяти работаем с int-ключами:
+    без str(uid) на каждый callback. При сериализации json/orjson сами
+    превратят int-ключи обратно в строки."""
+    for section in ("channel_by_user", "templates"):
+        src = data.get(section, {})
+        out = {}
+        for k, v in src.items():
+            try:
+                out[int(k)] = v
+            except (TypeError, ValueError):
+                out[k] = v
+        data[section] = out
+
+def _storage_payload(data: dict) -> dict:
+    """Приводит storage к сериализуемому виду: админы в памяти — set,
+    в файл уходит отсортированный список (стабильный и JSON-совместимый)."""
+    admins = data.get("admins")
+    if isinstance(admins, set):
+        data = {**data, "admins": sorted(admins)}
+    return data
+
+def _write_storage_bytes(payload: bytes, durable: bool = False) -> None:
+    """Атомная запись, чтобы не бить файл при сбоях.
+
+    fsync стоит миллисекунды на каждую запись и нужен только там, где важна
+    гарантия «пережить падение питания»: завершение работы и правки списка
+    админов. Обычные сохранения ограничиваются атомарным os.replace.
+    """
     tmp_fd, tmp_path = tempfile.mkstemp(dir=str(BASE_DIR), prefix="storage_", suffix=".json")
     try:
-        with os.fdopen(tmp_fd, "w", encoding="utf-8") as f:
-            f.write(json.dumps(data, ensure_ascii=False, indent=2))
-            f.flush()
-            os.fsync(f.fileno())
+        with os.fdopen(tmp_fd, "wb") as f:
+            f.write(payload)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
         os.replace(tmp_path, STORAGE_FILE)
+        _truncate_journal()
     finally:
         try:
             if os.path.exists(tmp_path):
@@ -93,6 +183,118 @@ def save_storage(data: dict) -> None:
         except Exception:
             pass
 
+def save_storage(data: dict, durable: bool = False) -> None:
+    _write_storage_bytes(_json_dumps(_storage_payload(data)), durable)
+
+# Отложенная запись: обработчики не пишут файл сами, а взводят флаг.
+# Фоновая задача собирает «пачку» изменений (шаги FSM, серию кликов)
+# в одну запись на диск не чаще, чем раз в FLUSH_DEBOUNCE_SEC.
+FLUSH_DEBOUNCE_SEC = 0.5
+_dirty = asyncio.Event()
+_storage_preview_cached: Optional[str] = None  # превью для /storage (см. _storage_preview)
+
+def mark_dirty() -> None:
+    global _storage_preview_cached, _buffered_dirty
+    _storage_preview_cached = None  # превью /storage пересоберётся лениво
+    if _buffer_depth:
+        _buffered_dirty = True
+        return
+    _dirty.set()
+
+# Пакетные мутации (импорт): внутри контекста mark_dirty копится во флаг,
+# на выходе флашер получает одно срабатывание вместо серии.
+_buffer_depth = 0
+_buffered_dirty = False
+
+@contextmanager
+def buffered_storage():
+    global _buffer_depth, _buffered_dirty
+    _buffer_depth += 1
+    try:
+        yield
+    finally:
+        _buffer_depth -= 1
+        if _buffer_depth == 0 and _buffered_dirty:
+            _buffered_dirty = False
+            _dirty.set()
+
+async def save_storage_async(data: dict, durable: bool = False) -> None:
+    """Запись в отдельном потоке: event loop не ждёт write/fsync/replace.
+
+    Сериализуем прямо в цикле событий: обработчики мутируют живой dict, и
+    обход его из рабочего потока ловил бы «dictionary changed size during
+    iteration». В поток уходят только готовые байты."""
+    payload = _json_dumps(_storage_payload(data))
+    await asyncio.to_thread(_write_storage_bytes, payload, durable)
+
+async def _storage_flusher() -> None:
+    while True:
+        await _dirty.wait()
+        await asyncio.sleep(FLUSH_DEBOUNCE_SEC)
+        _dirty.clear()
+        try:
+            await save_storage_async(storage)
+        except Exception as e:
+            # сбой записи (диск, гонка) не должен убивать флашер навсегда:
+            # вернём флаг, чтобы повторить на следующем цикле
+            print(f"⚠️ storage flush failed, will retry: {e}")
+            _dirty.set()
+
+# Журнал мутаций: пока снапшот ждёт дебаунс, каждая правка сразу дописывается
+# одной строкой в storage.journal.jsonl. При старте журнал реигрывается поверх
+# снапшота, а каждая успешная запись storage.json его усекает (компакция).
+
+def journal_append(op: dict) -> None:
+    try:
+        with JOURNAL_FILE.open("ab") as f:
+            f.write(_json_dumps(op) + b"\n")
+    except Exception:
+        pass
+    mark_dirty()
+
+def _truncate_journal() -> None:
+    try:
+        if JOURNAL_FILE.exists():
+            JOURNAL_FILE.write_bytes(b"")
+    except Exception:
+        pass
+
+def _apply_journal_op(data: dict, op: dict) -> None:
+    kind = op.get("op")
+    if kind == "tpl_set":
+        g, c, n = op["path"]
+        user = data.setdefault("templates", {}).setdefault(str(op["uid"]), {})
+        user.setdefault(g, {}).setdefault(c, {})[n] = op["val"]
+    elif kind == "tpl_del":
+        g, c, n = op["path"]
+        user = data.get("templates", {}).get(str(op["uid"]), {})
+        cheats = user.get(g, {})
+        cheats.get(c, {}).pop(n, None)
+        if not cheats.get(c):
+            cheats.pop(c, None)
+        if not user.get(g):
+            user.pop(g, None)
+    elif kind == "set_channel":
+        key = str(op["uid"])
+        data.setdefault("channel_by_user", {})[key] = {"id": op["id"], "title": op["title"]}
+    elif kind == "clear_channel":
+        data.setdefault("channel_by_user", {}).pop(str(op["uid"]), None)
+
+def _replay_journal(data: dict) -> None:
+    if not JOURNAL_FILE.exists():
+        return
+    try:
+        lines = JOURNAL_FILE.read_bytes().splitlines()
+    except Exception:
+        return
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            _apply_journal_op(data, _json_loads(line))
+        except Exception:
+            continue
+
 
 # ----------------------------- АУДИТ ----------------------------- #
 
@@ -101,43 +303,107 @@ def _ts() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M")
 
 def log_action(uid: int, text: str) -> None:
-    """Пишем одну строку в audit.log: [YYYY-mm-dd HH:MM] <uid> - text"""
+    """Строка аудита уходит в очередь: [YYYY-mm-dd HH:MM] <uid> - text.
+
+    Непосредственно на диск пишет фоновая задача _audit_writer — обработчики
+    не платят за open/write/close на каждое действие.
+    """
+    line = f"[{_ts()}] {uid} - {text}"
+    _audit_tail.append(line)
+    try:
+        _audit_q.put_nowait(line + "\n")
+    except Exception:
+        pass
+
+_audit_q: "asyncio.Queue[str]" = asyncio.Queue()
+
+# хвост аудита в памяти: owner:audit читает его за O(1), без похода на диск
+_audit_tail: "deque[str]" = deque(maxlen=64)
+
+def _audit_write(fh, data: str) -> None:
+    fh.write(data)
+    fh.flush()
+
+async def _audit_writer() -> None:
+    fh = AUDIT_FILE.open("a", encoding="utf-8")
+    try:
+        while True:
+            buf = [await _audit_q.get()]
+            while not _audit_q.empty():
+                buf.append(_audit_q.get_nowait())
+            await asyncio.to_thread(_audit_write, fh, "".join(buf))
+    finally:
+        fh.close()
+
+def _drain_audit_queue() -> None:
+    if _audit_q.empty():
+        return
     try:
-        line = f"[{_ts()}] {uid} - {text}\n"
         with AUDIT_FILE.open("a", encoding="utf-8") as f:
-            f.write(line)
+            while not _audit_q.empty():
+                f.write(_audit_q.get_nowait())
     except Exception:
         pass
 
 def tail_audit(n: int = 20) -> List[str]:
+    """Последние n строк audit.log: читаем блоками с конца, а не весь файл."""
     if not AUDIT_FILE.exists():
         return []
     try:
-        lines = AUDIT_FILE.read_text(encoding="utf-8", errors="ignore").splitlines()
-        return lines[-n:]
+        buf = b""
+        with AUDIT_FILE.open("rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            while pos > 0 and buf.count(b"\n") <= n:
+                step = min(8192, pos)
+                pos -= step
+                f.seek(pos)
+                buf = f.read(step) + buf
+        return buf.decode("utf-8", errors="ignore").splitlines()[-n:]
     except Exception:
         return []
 
+# при старте поднимаем хвост с диска один раз — дальше он живёт в памяти
+_audit_tail.extend(tail_audit(_audit_tail.maxlen))
+
 
 # ----------------------------- HELPERS: URL, FINGERPRINT, ADMIN CHECKS ----------------------------- #
 from urllib.parse import urlparse
 import hashlib as _hashlib
 import re as _re
 
-async def user_is_admin(chat_id: int, user_id: int) -> bool:
-    try:
-        admins = await bot.get_chat_administrators(chat_id)
-        return any(a.user.id == user_id for a in admins)
-    except Exception:
-        return False
-
-async def bot_is_admin(chat_id: int) -> bool:
+# Состав админов канала меняется редко — держим ответ get_chat_administrators
+# с TTL, чтобы серия проверок в одном диалоге не ходила в сеть каждый раз.
+ADMINS_CACHE_TTL = 60.0
+_admins_cache: Dict[int, Tuple[float, list]] = {}
+
+async def _get_chat_admins(chat_id: int) -> list:
+    now = time.monotonic()
+    cached = _admins_cache.get(chat_id)
+    if cached and now - cached[0] < ADMINS_CACHE_TTL:
+        return cached[1]
+    admins = await bot.get_chat_administrators(chat_id)
+    _admins_cache[chat_id] = (now, admins)
+    return admins
+
+# get_me() возвращает константу — не ходим за ней в Telegram на каждый чек
+_bot_me = None
+
+async def _get_me_cached():
+    global _bot_me
+    if _bot_me is None:
+        _bot_me = await bot.get_me()
+    return _bot_me
+
+async def _channel_admin_flags(chat_id: int, user_id: int) -> Tuple[bool, bool]:
+    # обе проверки подключения (пользователь админ? бот админ?) по одному
+    # списку админов канала; get_me и список уходят параллельно
     try:
-        me = await bot.get_me()
-        admins = await bot.get_chat_administrators(chat_id)
-        return any(a.user.id == me.id for a in admins)
+        admins, me = await asyncio.gather(_get_chat_admins(chat_id), _get_me_cached())
     except Exception:
-        return False
+        return False, False
+    ids = {a.user.id for a in admins}
+    return user_id in ids, me.id in ids
 
 def is_http_url(s: str) -> bool:
     try:
@@ -180,22 +446,48 @@ def has_duplicate_template(uid: int, fp: str) -> bool:
 
 # ----------------------------- МОДЕЛИ ----------------------------- #
 
-@dataclass
-class Button:
-    t: str
-    u: str
-
-@dataclass
+@dataclass(slots=True)
 class Draft:
+    """Черновик поста. Кнопки лежат в SoA-виде: параллельные списки текстов и
+    URL плюс индексы начала рядов — вместо вложенных списков объектов-кнопок.
+    slots=True: без __dict__ на экземпляр — меньше памяти и быстрее доступ."""
     text: str = ""
-    buttons: List[List[Button]] = field(default_factory=list)
+    btn_texts: List[str] = field(default_factory=list)
+    btn_urls: List[str] = field(default_factory=list)
+    row_starts: List[int] = field(default_factory=list)
     photo: Optional[str] = None
+    # готовый markup + снимок кнопок, по которому он построен
+    _markup_cache: Optional[Tuple[tuple, InlineKeyboardMarkup]] = field(default=None, repr=False)
+
+    def add_row(self) -> None:
+        self.row_starts.append(len(self.btn_texts))
+
+    def add_button(self, text: str, url: str) -> None:
+        if not self.row_starts:
+            self.row_starts.append(len(self.btn_texts))
+        self.btn_texts.append(text)
+        self.btn_urls.append(url)
+
+    def _row_bounds(self) -> List[Tuple[int, int]]:
+        starts = self.row_starts
+        total = len(self.btn_texts)
+        return [(starts[r], starts[r + 1] if r + 1 < len(starts) else total)
+                for r in range(len(starts))]
+
+    def rows(self) -> List[List[Tuple[str, str]]]:
+        t, u = self.btn_texts, self.btn_urls
+        return [[(t[i], u[i]) for i in range(lo, hi)] for lo, hi in self._row_bounds()]
 
     def as_markup(self) -> InlineKeyboardMarkup:
-        rows = []
-        for row in self.buttons:
-            rows.append([InlineKeyboardButton(text=b.t, url=b.u) for b in row])
-        return InlineKeyboardMarkup(inline_keyboard=rows)
+        key = (tuple(self.btn_texts), tuple(self.btn_urls), tuple(self.row_starts))
+        if self._markup_cache is not None and self._markup_cache[0] == key:
+            return self._markup_cache[1]
+        t, u = self.btn_texts, self.btn_urls
+        rows = [[InlineKeyboardButton(text=t[i], url=u[i]) for i in range(lo, hi)]
+                for lo, hi in self._row_bounds()]
+        markup = InlineKeyboardMarkup(inline_keyboard=rows)
+        self._markup_cache = (key, markup)
+        return markup
 
 
 # ----------------------------- FSM ----------------------------- #
@@ -237,33 +529,127 @@ ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().
 storage = load_storage()
 
 # миграция: если "templates" не в per-user формате, заворачиваем в OWNER_ID (или "0")
-def _looks_like_user_key(k: str) -> bool:
-    s = k.lstrip("-")
-    return s.isdigit() and len(s) >= 5
+def _looks_like_user_key(k) -> bool:
+    try:
+        return abs(int(k)) >= 10000
+    except (TypeError, ValueError):
+        return False
 
 def migrate_templates_per_user():
     tpls = storage.get("templates", {})
     if not tpls:
         return
     if not all(_looks_like_user_key(k) for k in tpls.keys()):
-        ns = str(OWNER_ID) if OWNER_ID else "0"
+        ns = OWNER_ID if OWNER_ID else 0
         storage["templates"] = {ns: tpls}
         save_storage(storage)
 migrate_templates_per_user()
 
 def tpls_of(uid: int) -> Dict[str, dict]:
-    return storage.setdefault("templates", {}).setdefault(str(uid), {})
+    # ключ "templates" гарантирован слиянием DEFAULT_STORAGE в load_storage
+    return storage["templates"].setdefault(uid, {})
+
+def _tpl_insert(tpls: Dict[str, dict], game: str, cheat: str, name: str, payload: dict) -> None:
+    # EAFP вместо цепочки setdefault: setdefault аллоцирует {} под default
+    # даже при существующем ключе, а в цикле импорта это каждая запись
+    try:
+        gmap = tpls[game]
+    except KeyError:
+        gmap = tpls[game] = {}
+    try:
+        chmap = gmap[cheat]
+    except KeyError:
+        chmap = gmap[cheat] = {}
+    chmap[name] = payload
+
+# Держим ключи шаблонов отсортированными в момент записи (insertion order
+# словаря = порядок показа) — тогда чтение обходится вовсе без sort.
+def _casefold_item(kv) -> str:
+    return kv[0].casefold()
+
+def _resort_user_tpls(uid: int) -> None:
+    """Пересортировать дерево шаблонов пользователя после вставки ключей."""
+    tpls = tpls_of(uid)
+    for g, cheats in tpls.items():
+        for c, names in cheats.items():
+            cheats[c] = dict(sorted(names.items(), key=_casefold_item))
+        tpls[g] = dict(sorted(cheats.items(), key=_casefold_item))
+    storage["templates"][uid] = dict(sorted(tpls.items(), key=_casefold_item))
+
+def _normalize_template_order() -> None:
+    for uid_key in list(storage.get("templates", {}).keys()):
+        if isinstance(uid_key, int):
+            _resort_user_tpls(uid_key)
+_normalize_template_order()
+
+# Плоский индекс (uid, игра, чит, имя) -> payload: горячие tpl:send/tpl:prev
+# делают один lookup вместо прохода по трём вложенным словарям.
+_flat_tpls: Dict[Tuple[int, str, str, str], dict] = {}
+
+def _rebuild_flat_tpls() -> None:
+    _flat_tpls.clear()
+    for uid, user_tpls in storage.get("templates", {}).items():
+        if not isinstance(uid, int):
+            continue
+        for g, cheats in user_tpls.items():
+            for c, names in cheats.items():
+                for n, payload in names.items():
+                    _flat_tpls[(uid, g, c, n)] = payload
+_rebuild_flat_tpls()
 
 # зафиксировать список админов
 seed_admins = set(storage.get("admins", [])) | set(ADMIN_IDS)
 if OWNER_ID:
     seed_admins.add(OWNER_ID)
-storage["admins"] = sorted(seed_admins)
+
+# Горячая проверка прав: AdminGuard дергает её на каждый апдейт, поэтому
+# в памяти админы живут множеством (оно же лежит в storage["admins"]);
+# в отсортированный список их превращает только _storage_payload при записи.
+_admins_set: set = seed_admins
+storage["admins"] = _admins_set
 save_storage(storage)
 
+# Канал пользователя нужен на каждый рендер главного меню — привязываем
+# словарь один раз, чтобы не проходить через storage.get на каждый клик.
+# Обработчики подключения/очистки мутируют этот же объект через storage.
+_channel_by_user: Dict[int, dict] = storage.setdefault("channel_by_user", {})
+
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
-user_drafts: Dict[int, Draft] = {}
+# Черновики: LRU с потолком, иначе словарь растёт на каждого зашедшего
+# пользователя и не освобождается никогда.
+DRAFTS_MAX = 1024
+user_drafts: "OrderedDict[int, Draft]" = OrderedDict()
+
+def _draft_of(uid: int, fresh: bool = False) -> Draft:
+    d = None if fresh else user_drafts.get(uid)
+    if d is None:
+        d = Draft()
+    user_drafts[uid] = d
+    user_drafts.move_to_end(uid)
+    while len(user_drafts) > DRAFTS_MAX:
+        user_drafts.popitem(last=False)
+    return d
+
+async def _prefetch_me():
+    try:
+        await _get_me_cached()
+    except Exception:
+        pass
+
+@dp.startup()
+async def _on_startup():
+    asyncio.create_task(_storage_flusher())
+    asyncio.create_task(_audit_writer())
+    asyncio.create_task(_sender_worker())
+    asyncio.create_task(_prefetch_me())
+
+@dp.shutdown()
+async def _on_shutdown():
+    # финальный сброс, чтобы не потерять хвост отложенных изменений
+    if _dirty.is_set():
+        save_storage(storage, durable=True)
+    _drain_audit_queue()
 
 
 # ----------------------------- УТИЛИТЫ ----------------------------- #
@@ -271,53 +657,97 @@ user_drafts: Dict[int, Draft] = {}
 def is_owner(uid: int) -> bool:
     return OWNER_ID and uid == OWNER_ID
 
-def is_admin(uid: int) -> bool:
-    return uid in set(storage.get("admins", []))
-
 def admin_only(uid: int) -> bool:
-    return is_owner(uid) or is_admin(uid)
+    # критический путь AdminGuard: без цепочки вызовов, одно сравнение
+    # и одна проба множества
+    return uid == OWNER_ID or uid in _admins_set
+
+# Запоминаем, что уже показано в сообщении: повторный клик по тому же пункту
+# меню не должен стоить round-trip к Telegram ради "message is not modified".
+# LRU, а не обычный dict: у бота с годами аптайма ключей (chat, message)
+# накопилось бы неограниченно много
+_LAST_EDIT_MAX = 1024
+_last_edit: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+
+def _remember_edit(key: Tuple[int, int], payload: int) -> None:
+    _last_edit[key] = payload
+    _last_edit.move_to_end(key)
+    while len(_last_edit) > _LAST_EDIT_MAX:
+        _last_edit.popitem(last=False)
 
 async def safe_edit_text(msg: Message, text: str, **kwargs):
+    key = (msg.chat.id, msg.message_id)
+    payload = hash((text, repr(kwargs.get("reply_markup"))))
+    if _last_edit.get(key) == payload:
+        _last_edit.move_to_end(key)
+        return
     try:
         await msg.edit_text(text, **kwargs)
+        _remember_edit(key, payload)
     except TelegramBadRequest as e:
         err = str(e).lower()
         if "message is not modified" in err:
             try:
                 await msg.edit_text(text + "\u200B", **kwargs)
+                _remember_edit(key, payload)
                 return
             except TelegramBadRequest:
                 pass
         await msg.answer(text, **kwargs)
 
-def back_menu_kb() -> InlineKeyboardMarkup:
+# Статичные клавиатуры строим один раз: aiogram не мутирует markup при
+# отправке, так что один объект можно переиспользовать во всех ответах.
+def _build_back_menu_kb() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.button(text="⬅️ В меню", callback_data="menu:back")
     return kb.as_markup()
 
+_BACK_MENU_KB = _build_back_menu_kb()
+
+def back_menu_kb() -> InlineKeyboardMarkup:
+    return _BACK_MENU_KB
+
 def channel_label_for_user(uid: int) -> str:
-    label = storage.get("channel_titles", {}).get(str(uid))
-    return label if label else "не подключён"
+    entry = _channel_by_user.get(uid)
+    return (entry["title"] if entry is not None else None) or "не подключён"
+
+def channel_id_of(uid: int) -> Optional[int]:
+    entry = _channel_by_user.get(uid)
+    return entry["id"] if entry is not None else None
+
+# Меню зависят только от (метка канала, владелец?) — мемоизируем готовые
+# markup-объекты; смена канала даёт новую метку и, значит, новый ключ кэша.
+# Статичные кнопки главного меню создаём один раз на импорт: меняется
+# только кнопка с меткой канала.
+_MAIN_BTN_CREATE = InlineKeyboardButton(text="📝 Создать пост", callback_data="menu:create")
+_MAIN_BTN_READY = InlineKeyboardButton(text="📚 Готовые посты", callback_data="menu:ready")
+_MAIN_BTN_MANAGE = InlineKeyboardButton(text="🧩 Управление шаблонами", callback_data="menu:manage")
+_MAIN_ROW_OWNER = [
+    InlineKeyboardButton(text="👥 Админы и каналы", callback_data="owner:panel"),
+    InlineKeyboardButton(text="🧾 Аудит-лог действий", callback_data="owner:audit"),  # NEW
+]
+
+@lru_cache(maxsize=512)
+def _main_menu_kb(label: str, owner: bool) -> InlineKeyboardMarkup:
+    rows = [
+        [_MAIN_BTN_CREATE, _MAIN_BTN_READY],
+        [_MAIN_BTN_MANAGE, InlineKeyboardButton(text=f"⚙️ Канал: {label}", callback_data="menu:settings")],
+    ]
+    if owner:
+        rows.append(_MAIN_ROW_OWNER)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
 def main_menu_kb(uid: int) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    kb.button(text="📝 Создать пост", callback_data="menu:create")
-    kb.button(text="📚 Готовые посты", callback_data="menu:ready")
-    kb.button(text="🧩 Управление шаблонами", callback_data="menu:manage")
-    kb.button(text=f"⚙️ Канал: {channel_label_for_user(uid)}", callback_data="menu:settings")
-    if is_owner(uid):
-        kb.button(text="👥 Админы и каналы", callback_data="owner:panel")
-        kb.button(text="🧾 Аудит-лог действий", callback_data="owner:audit")  # NEW
-    kb.adjust(2, 2, 2 if is_owner(uid) else 0)
-    return kb.as_markup()
+    return _main_menu_kb(channel_label_for_user(uid), is_owner(uid))
 
-def settings_menu_kb(uid: int) -> InlineKeyboardMarkup:
+@lru_cache(maxsize=512)
+def _settings_menu_kb(label: str, owner: bool) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
-    kb.button(text=f"Канал: {channel_label_for_user(uid)}", callback_data="noop")
+    kb.button(text=f"Канал: {label}", callback_data="noop")
     kb.button(text="📩 Подключить канал", callback_data="set:connect")
     kb.button(text="🧪 Проверить отправку", callback_data="set:test")
     kb.button(text="❌ Очистить канал", callback_data="set:clear")
-    if is_owner(uid):
+    if owner:
         kb.button(text="👤 Добавить админа", callback_data="set:add_admin")
         kb.button(text="🗑 Удалить админа", callback_data="set:del_admin")
         kb.button(text="📜 Список админов", callback_data="set:list_admins")
@@ -326,12 +756,16 @@ def settings_menu_kb(uid: int) -> InlineKeyboardMarkup:
     kb.adjust(1, 2, 1, 2, 1)
     return kb.as_markup()
 
-def compose_kb(draft: Optional[Draft] = None) -> InlineKeyboardMarkup:
+def settings_menu_kb(uid: int) -> InlineKeyboardMarkup:
+    return _settings_menu_kb(channel_label_for_user(uid), is_owner(uid))
+
+@lru_cache(maxsize=2)
+def _compose_kb(has_photo: bool) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.button(text="➕ Добавить кнопку", callback_data="compose:add_btn")
     kb.button(text="⤵️ Добавить ряд", callback_data="compose:add_row")
     kb.button(text="🖼 Добавить фото", callback_data="compose:add_photo")
-    if draft and draft.photo:
+    if has_photo:
         kb.button(text="🧹 Удалить фото", callback_data="compose:del_photo")
     kb.button(text="🔍 Предпросмотр", callback_data="compose:preview")
     kb.button(text="📤 Отправить в канал", callback_data="compose:send")
@@ -339,26 +773,50 @@ def compose_kb(draft: Optional[Draft] = None) -> InlineKeyboardMarkup:
     kb.adjust(2, 2, 2)
     return kb.as_markup()
 
-def build_matrix_preview(buttons: List[List[Button]]) -> str:
-    if not buttons:
+def compose_kb(draft: Optional[Draft] = None) -> InlineKeyboardMarkup:
+    return _compose_kb(bool(draft and draft.photo))
+
+def build_matrix_preview(d: Draft) -> str:
+    rows = d.rows()
+    if not rows:
         return "(кнопок нет)"
     lines = []
-    for i, row in enumerate(buttons, start=1):
-        cols = [f"{b.t} ({b.u})" for b in row]
+    for i, row in enumerate(rows, start=1):
+        cols = [f"{t} ({u})" for t, u in row]
         lines.append(f"Ряд {i}: " + " | ".join(cols))
     return "\n".join(lines)
 
 # ---------- Индексация путей, чтобы callback_data были короткими ---------- #
 
+# Отсортированные списки нужны по несколько раз на каждый callback —
+# кешируем их на пользователя и сбрасываем при любой мутации шаблонов.
+_tpl_cache: Dict[int, dict] = {}
+
+def _invalidate_tpl_cache(uid: int) -> None:
+    _tpl_cache.pop(uid, None)
+
+def _tpl_cache_of(uid: int) -> dict:
+    c = _tpl_cache.get(uid)
+    if c is None:
+        c = _tpl_cache[uid] = {"games": None, "cheats": {}, "names": {}, "markups": {}}
+    return c
+
 def list_games(uid: int) -> List[str]:
-    return sorted(tpls_of(uid).keys(), key=str.lower)
+    c = _tpl_cache_of(uid)
+    if c["games"] is None:
+        c["games"] = list(tpls_of(uid).keys())
+    return c["games"]
 
 def list_cheats(uid: int, gidx: int) -> List[str]:
     games = list_games(uid)
     if gidx < 0 or gidx >= len(games):
         return []
     game = games[gidx]
-    return sorted(tpls_of(uid)[game].keys(), key=str.lower)
+    c = _tpl_cache_of(uid)
+    cheats = c["cheats"].get(game)
+    if cheats is None:
+        cheats = c["cheats"][game] = list(tpls_of(uid)[game].keys())
+    return cheats
 
 def list_names(uid: int, gidx: int, cidx: int) -> List[str]:
     games = list_games(uid)
@@ -369,31 +827,49 @@ def list_names(uid: int, gidx: int, cidx: int) -> List[str]:
     if cidx < 0 or cidx >= len(cheats):
         return []
     cheat = cheats[cidx]
-    return sorted(tpls_of(uid)[game][cheat].keys(), key=str.lower)
-
+    c = _tpl_cache_of(uid)
+    names = c["names"].get((game, cheat))
+    if names is None:
+        names = c["names"][(game, cheat)] = list(tpls_of(uid)[game][cheat].keys())
+    return names
+
+# Меню шаблонов меняются только при мутации шаблонов — готовые markup'ы
+# живут в _tpl_cache и сбрасываются вместе со списками.
 def templates_menu(uid: int) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    for i, game in enumerate(list_games(uid)):
-        kb.button(text=game[:64], callback_data=f"tpl:g#{i}")
-    kb.button(text="⬅️ В меню", callback_data="menu:back")
-    kb.adjust(2)
-    return kb.as_markup()
+    markups = _tpl_cache_of(uid)["markups"]
+    mk = markups.get("games")
+    if mk is None:
+        kb = InlineKeyboardBuilder()
+        for i, game in enumerate(list_games(uid)):
+            kb.button(text=game[:64], callback_data=f"tpl:g#{i}")
+        kb.button(text="⬅️ В меню", callback_data="menu:back")
+        kb.adjust(2)
+        mk = markups["games"] = kb.as_markup()
+    return mk
 
 def cheats_menu(uid: int, gidx: int) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    for i, cheat in enumerate(list_cheats(uid, gidx)):
-        kb.button(text=cheat[:64], callback_data=f"tpl:c#{gidx}#{i}")
-    kb.button(text="⬅️ Назад", callback_data="tpl:back:games")
-    kb.adjust(2)
-    return kb.as_markup()
+    markups = _tpl_cache_of(uid)["markups"]
+    mk = markups.get(("c", gidx))
+    if mk is None:
+        kb = InlineKeyboardBuilder()
+        for i, cheat in enumerate(list_cheats(uid, gidx)):
+            kb.button(text=cheat[:64], callback_data=f"tpl:c#{gidx}#{i}")
+        kb.button(text="⬅️ Назад", callback_data="tpl:back:games")
+        kb.adjust(2)
+        mk = markups[("c", gidx)] = kb.as_markup()
+    return mk
 
 def names_menu(uid: int, gidx: int, cidx: int) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    for i, name in enumerate(list_names(uid, gidx, cidx)):
-        kb.button(text=name[:64], callback_data=f"tpl:n#{gidx}#{cidx}#{i}")
-    kb.button(text="⬅️ Назад", callback_data=f"tpl:back:cheats#{gidx}")
-    kb.adjust(2)
-    return kb.as_markup()
+    markups = _tpl_cache_of(uid)["markups"]
+    mk = markups.get(("n", gidx, cidx))
+    if mk is None:
+        kb = InlineKeyboardBuilder()
+        for i, name in enumerate(list_names(uid, gidx, cidx)):
+            kb.button(text=name[:64], callback_data=f"tpl:n#{gidx}#{cidx}#{i}")
+        kb.button(text="⬅️ Назад", callback_data=f"tpl:back:cheats#{gidx}")
+        kb.adjust(2)
+        mk = markups[("n", gidx, cidx)] = kb.as_markup()
+    return mk
 
 def template_view_kb_by_idx(gidx: int, cidx: int, nidx: int) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
@@ -403,7 +879,7 @@ def template_view_kb_by_idx(gidx: int, cidx: int, nidx: int) -> InlineKeyboardMa
     kb.adjust(2, 1)
     return kb.as_markup()
 
-def manage_menu() -> InlineKeyboardMarkup:
+def _build_manage_menu() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.button(text="➕ Добавить шаблон", callback_data="m:add")
     kb.button(text="🗑 Удалить шаблон", callback_data="m:del")
@@ -414,46 +890,82 @@ def manage_menu() -> InlineKeyboardMarkup:
     kb.adjust(2, 2, 1)
     return kb.as_markup()
 
-def matrix_to_markup(matrix: List[List[Dict[str, str]]]) -> InlineKeyboardMarkup:
-    rows = []
-    for row in matrix:
-        rows.append([InlineKeyboardButton(text=btn["t"], url=btn["u"]) for btn in row])
+_MANAGE_MENU_KB = _build_manage_menu()
+
+def manage_menu() -> InlineKeyboardMarkup:
+    return _MANAGE_MENU_KB
+
+@lru_cache(maxsize=256)
+def _markup_from_frozen(frozen: Tuple[Tuple[Tuple[str, str], ...], ...]) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=t, url=u) for t, u in row] for row in frozen]
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+def matrix_to_markup(matrix: List[List[Dict[str, str]]]) -> InlineKeyboardMarkup:
+    # повторная отправка того же шаблона отдаёт закешированный markup
+    frozen = tuple(tuple((btn["t"], btn["u"]) for btn in row) for row in matrix)
+    return _markup_from_frozen(frozen)
+
 
 # ----------------------------- ССЫЛКИ (для панели владельца) ----------------------------- #
 
+# имена и заголовки каналов повторяются от клика к клику — escape мемоизируем
+_esc = lru_cache(maxsize=1024)(html.escape)
+
+# сам get_chat — сетевой RTT; профиль чата меняется редко, держим 5 минут
+CHAT_CACHE_TTL = 300.0
+_chat_cache: Dict[int, Tuple[float, Chat]] = {}
+
+async def cached_get_chat(chat_id: int) -> Chat:
+    cached = _chat_cache.get(chat_id)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < CHAT_CACHE_TTL:
+        return cached[1]
+    chat = await bot.get_chat(chat_id)
+    _chat_cache[chat_id] = (now, chat)
+    return chat
+
 async def get_user_display(user_id: int) -> Tuple[str, str]:
     try:
-        chat: Chat = await bot.get_chat(user_id)
-        name = html.escape(chat.full_name or "user")
+        chat: Chat = await cached_get_chat(user_id)
+        name = _esc(chat.full_name or "user")
         if chat.username:
             return f'<a href="https://t.me/{chat.username}">{name}</a>', name
         return f'<a href="tg://user?id={user_id}">{name}</a>', name
     except Exception:
         return f'<a href="tg://user?id={user_id}">{user_id}</a>', str(user_id)
 
+# готовые HTML-строки для панели: каждая стоит get_chat (сетевой RTT),
+# поэтому держим их с TTL, как кэш админов канала
+DISPLAY_CACHE_TTL = 60.0
+_channel_display_cache: Dict[int, Tuple[float, str]] = {}
+
 async def get_channel_display(channel_id: int) -> str:
+    cached = _channel_display_cache.get(channel_id)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < DISPLAY_CACHE_TTL:
+        return cached[1]
     try:
-        chat: Chat = await bot.get_chat(channel_id)
-        title = html.escape(chat.title or "Канал")
+        chat: Chat = await cached_get_chat(channel_id)
+        title = _esc(chat.title or "Канал")
         if chat.username:
-            return f'<a href="https://t.me/{chat.username}">{title}</a> (<code>{channel_id}</code>)'
-        return f'{title} (<code>{channel_id}</code>)'
+            out = f'<a href="https://t.me/{chat.username}">{title}</a> (<code>{channel_id}</code>)'
+        else:
+            out = f'{title} (<code>{channel_id}</code>)'
     except Exception:
-        return f'канал (<code>{channel_id}</code>)'
+        out = f'канал (<code>{channel_id}</code>)'
+    _channel_display_cache[channel_id] = (now, out)
+    return out
 
 
 # ----------------------------- ГЛОБАЛЬНАЯ ЗАЩИТА ----------------------------- #
 
 class AdminGuard(BaseMiddleware):
+    __slots__ = ()
+
     async def __call__(self, handler, event, data):
-        from aiogram.types import Message, CallbackQuery
-        uid = None
-        if isinstance(event, Message) and event.from_user:
-            uid = event.from_user.id
-        elif isinstance(event, CallbackQuery) and event.from_user:
-            uid = event.from_user.id
+        # и Message, и CallbackQuery несут from_user — isinstance-лесенка не нужна
+        from_user = getattr(event, "from_user", None)
+        uid = from_user.id if from_user else None
 
         if not uid:
             return await handler(event, data)
@@ -480,13 +992,29 @@ async def start_cmd(m: Message):
 async def echo_id(m: Message):
     await m.answer(f"chat_id: <code>{m.chat.id}</code>\nuser_id: <code>{m.from_user.id}</code>")
 
+def _storage_preview(limit: int = 800) -> str:
+    """Первые limit символов JSON-вида storage без полной сериализации:
+    iterencode останавливается, как только набрали достаточно текста.
+    Результат живёт до следующего mark_dirty()."""
+    global _storage_preview_cached
+    if _storage_preview_cached is not None:
+        return _storage_preview_cached
+    chunks: List[str] = []
+    total = 0
+    for chunk in json.JSONEncoder(ensure_ascii=False).iterencode(_storage_payload(storage)):
+        chunks.append(chunk)
+        total += len(chunk)
+        if total >= limit:
+            break
+    _storage_preview_cached = "".join(chunks)[:limit]
+    return _storage_preview_cached
+
 @dp.message(Command("storage"))
 async def show_storage(m: Message):
     try:
-        import time
         file_exists = STORAGE_FILE.exists()
         mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(STORAGE_FILE.stat().st_mtime)) if file_exists else "—"
-        mem_preview = json.dumps(storage, ensure_ascii=False)[:800]
+        mem_preview = _storage_preview(800)
         await m.answer(
             "🧾 <b>storage.json</b>\n"
             f"Путь: <code>{STORAGE_FILE}</code>\n"
@@ -511,23 +1039,21 @@ async def menu_back(c: CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data == "menu:create")
 async def create_post(c: CallbackQuery, state: FSMContext):
-    user_drafts[c.from_user.id] = Draft()
+    _draft_of(c.from_user.id, fresh=True)
     await state.set_state(ComposeStates.WAIT_TEXT)
     await safe_edit_text(c.message, "✏️ Отправь <b>текст поста</b> (HTML допустим).", reply_markup=back_menu_kb())
     await c.answer()
 
 @dp.message(ComposeStates.WAIT_TEXT)
 async def get_post_text(m: Message, state: FSMContext):
-    d = user_drafts.get(m.from_user.id, Draft())
+    d = _draft_of(m.from_user.id)
     d.text = m.html_text or m.text or ""
-    user_drafts[m.from_user.id] = d
     await state.clear()
-    await m.answer(f"✅ Текст сохранён.\n\n{build_matrix_preview(d.buttons)}", reply_markup=compose_kb(d))
+    await m.answer(f"✅ Текст сохранён.\n\n{build_matrix_preview(d)}", reply_markup=compose_kb(d))
 
 @dp.callback_query(F.data.startswith("compose:"))
 async def compose_actions(c: CallbackQuery, state: FSMContext):
-    d = user_drafts.get(c.from_user.id, Draft())
-    user_drafts[c.from_user.id] = d
+    d = _draft_of(c.from_user.id)
     action = c.data.split(":")[1]
 
     if action == "add_btn":
@@ -535,7 +1061,7 @@ async def compose_actions(c: CallbackQuery, state: FSMContext):
         await safe_edit_text(c.message, "🆕 Введи <b>текст кнопки</b>:", reply_markup=back_menu_kb())
 
     elif action == "add_row":
-        d.buttons.append([])
+        d.add_row()
         await safe_edit_text(c.message, "Добавлен новый ряд кнопок.", reply_markup=compose_kb(d))
 
     elif action == "add_photo":
@@ -556,9 +1082,8 @@ async def compose_actions(c: CallbackQuery, state: FSMContext):
 
 @dp.message(ComposeStates.WAIT_PHOTO, F.photo)
 async def add_photo(m: Message, state: FSMContext):
-    d = user_drafts.get(m.from_user.id, Draft())
+    d = _draft_of(m.from_user.id)
     d.photo = m.photo[-1].file_id
-    user_drafts[m.from_user.id] = d
     await state.clear()
     await m.answer("✅ Фото сохранено.", reply_markup=compose_kb(d))
 
@@ -579,13 +1104,10 @@ async def add_btn_url(m: Message, state: FSMContext):
     data = await state.get_data()
     text = data.get("btn_text", "")
 
-    d = user_drafts.get(m.from_user.id, Draft())
-    if not d.buttons:
-        d.buttons.append([])
-    d.buttons[-1].append(Button(t=text, u=url))
-    user_drafts[m.from_user.id] = d
+    d = _draft_of(m.from_user.id)
+    d.add_button(text, url)
     await state.clear()
-    await m.answer(f"✅ Кнопка добавлена.\n\n{build_matrix_preview(d.buttons)}", reply_markup=compose_kb(d))
+    await m.answer(f"✅ Кнопка добавлена.\n\n{build_matrix_preview(d)}", reply_markup=compose_kb(d))
 
 async def preview_post(c: CallbackQuery, d: Draft):
     if d.photo:
@@ -594,15 +1116,55 @@ async def preview_post(c: CallbackQuery, d: Draft):
         await c.message.answer(d.text, reply_markup=d.as_markup())
     await c.answer("📤 Предпросмотр отправлен выше")
 
+# --- Очередь отправки в каналы --- #
+# Telegram режет ботов примерно на 30 сообщениях/с суммарно и ~1/с в один
+# чат. Все отправки в каналы идут через одного воркера, который выдерживает
+# паузы; обработчик ждёт ack-future и отвечает пользователю как раньше.
+SEND_GAP_GLOBAL = 1.0 / 30.0
+SEND_GAP_PER_CHAT = 1.0
+
+_send_queue: "asyncio.Queue[Tuple[int, Optional[str], str, Optional[InlineKeyboardMarkup], asyncio.Future]]" = asyncio.Queue()
+_last_sent_global = 0.0
+_last_sent_chat: Dict[int, float] = {}
+
+async def _sender_worker() -> None:
+    global _last_sent_global
+    while True:
+        chat_id, photo, text, kb, fut = await _send_queue.get()
+        now = time.monotonic()
+        wait = max(
+            _last_sent_global + SEND_GAP_GLOBAL - now,
+            _last_sent_chat.get(chat_id, 0.0) + SEND_GAP_PER_CHAT - now,
+        )
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            if photo:
+                await bot.send_photo(chat_id=chat_id, photo=photo, caption=text, reply_markup=kb)
+            else:
+                await bot.send_message(chat_id=chat_id, text=text, reply_markup=kb)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            if not fut.done():
+                fut.set_result(None)
+        now = time.monotonic()
+        _last_sent_global = now
+        _last_sent_chat[chat_id] = now
+
+async def _enqueue_send(chat_id: int, photo: Optional[str], text: str,
+                        kb: Optional[InlineKeyboardMarkup]) -> None:
+    fut = asyncio.get_running_loop().create_future()
+    await _send_queue.put((chat_id, photo, text, kb, fut))
+    await fut
+
 async def send_post_to_channel(c: CallbackQuery, d: Draft):
-    ch = storage.get("channels", {}).get(str(c.from_user.id))
+    ch = channel_id_of(c.from_user.id)
     if not ch:
         return await c.answer("⚠️ Сначала подключи свой канал в ⚙️ Настройках", show_alert=True)
     try:
-        if d.photo:
-            await bot.send_photo(chat_id=ch, photo=d.photo, caption=d.text, reply_markup=d.as_markup())
-        else:
-            await bot.send_message(chat_id=ch, text=d.text, reply_markup=d.as_markup())
+        await _enqueue_send(ch, d.photo, d.text, d.as_markup())
         log_action(c.from_user.id, "Отправил пост в свой канал (из черновика)")
         await c.answer("✅ Отправлено в твой канал!", show_alert=True)
     except Exception as e:
@@ -618,60 +1180,42 @@ async def ready_root(c: CallbackQuery):
     await safe_edit_text(c.message, "📚 Выбери игру:", reply_markup=templates_menu(c.from_user.id))
     await c.answer()
 
-@dp.callback_query(F.data == "tpl:back:games")
-async def back_to_games(c: CallbackQuery):
-    await safe_edit_text(c.message, "📚 Выбери игру:", reply_markup=templates_menu(c.from_user.id))
-    await c.answer()
+# Все tpl:* коллбеки разбираются одним компилированным regex и уходят через
+# словарь-диспетчер — вместо восьми handler'ов со своими split/int/try-except.
+_TPL_CB_RE = _re.compile(
+    r"^tpl:(back:games|back:cheats|back:templates|prev|send|g|c|n)"
+    r"(?:#(\d+))?(?:#(\d+))?(?:#(\d+))?$"
+)
 
-@dp.callback_query(F.data.startswith("tpl:g#"))
-async def choose_game(c: CallbackQuery):
-    try:
-        gidx = int(c.data.split("#")[1])
-    except Exception:
-        return await c.answer("Некорректные данные", show_alert=True)
-    await safe_edit_text(c.message, "🎮 Выбери чит:", reply_markup=cheats_menu(c.from_user.id, gidx))
+def _tpl_by_idx(uid: int, gidx: int, cidx: int, nidx: int) -> Optional[Tuple[str, str, str, dict]]:
+    games = list_games(uid)
+    cheats = list_cheats(uid, gidx)
+    names = list_names(uid, gidx, cidx)
+    if not games or not cheats or nidx < 0 or nidx >= len(names):
+        return None
+    game, cheat, name = games[gidx], cheats[cidx], names[nidx]
+    payload = _flat_tpls.get((uid, game, cheat, name))
+    if payload is None:
+        return None
+    return game, cheat, name, payload
+
+async def _tpl_show_games(c: CallbackQuery, gidx: int, cidx: int, nidx: int):
+    await safe_edit_text(c.message, "📚 Выбери игру:", reply_markup=templates_menu(c.from_user.id))
     await c.answer()
 
-@dp.callback_query(F.data.startswith("tpl:back:cheats#"))
-async def back_to_cheats(c: CallbackQuery):
-    try:
-        gidx = int(c.data.split("#")[1])
-    except Exception:
-        return await c.answer("Некорректные данные", show_alert=True)
+async def _tpl_show_cheats(c: CallbackQuery, gidx: int, cidx: int, nidx: int):
     await safe_edit_text(c.message, "🎮 Выбери чит:", reply_markup=cheats_menu(c.from_user.id, gidx))
     await c.answer()
 
-@dp.callback_query(F.data.startswith("tpl:c#"))
-async def choose_cheat(c: CallbackQuery):
-    try:
-        _, payload = c.data.split("#", 1)
-        gidx_s, cidx_s = payload.split("#")
-        gidx, cidx = int(gidx_s), int(cidx_s)
-    except Exception:
-        return await c.answer("Некорректные данные", show_alert=True)
+async def _tpl_show_names(c: CallbackQuery, gidx: int, cidx: int, nidx: int):
     await safe_edit_text(c.message, "💾 Выбери шаблон:", reply_markup=names_menu(c.from_user.id, gidx, cidx))
     await c.answer()
 
-@dp.callback_query(F.data.startswith("tpl:n#"))
-async def choose_name(c: CallbackQuery):
-    uid = c.from_user.id
-    try:
-        _, payload = c.data.split("#", 1)
-        gidx_s, cidx_s, nidx_s = payload.split("#")
-        gidx, cidx, nidx = int(gidx_s), int(cidx_s), int(nidx_s)
-    except Exception:
-        return await c.answer("Некорректные данные", show_alert=True)
-
-    games = list_games(uid)
-    cheats = list_cheats(uid, gidx)
-    names = list_names(uid, gidx, cidx)
-    if not games or not cheats or not names:
+async def _tpl_show_template(c: CallbackQuery, gidx: int, cidx: int, nidx: int):
+    found = _tpl_by_idx(c.from_user.id, gidx, cidx, nidx)
+    if not found:
         return await c.answer("Не найдено", show_alert=True)
-
-    game = games[gidx]
-    cheat = cheats[cidx]
-    name = names[nidx]
-    t = tpls_of(uid)[game][cheat][name]
+    game, cheat, name, t = found
     text = t.get("text", "")
     await safe_edit_text(
         c.message,
@@ -680,82 +1224,57 @@ async def choose_name(c: CallbackQuery):
     )
     await c.answer()
 
-@dp.callback_query(F.data.startswith("tpl:prev#"))
-async def tpl_preview(c: CallbackQuery):
-    uid = c.from_user.id
-    try:
-        _, payload = c.data.split("#", 1)
-        gidx_s, cidx_s, nidx_s = payload.split("#")
-        gidx, cidx, nidx = int(gidx_s), int(cidx_s), int(nidx_s)
-    except Exception:
-        return await c.answer("Некорректные данные", show_alert=True)
-
-    games = list_games(uid)
-    cheats = list_cheats(uid, gidx)
-    names = list_names(uid, gidx, cidx)
-    if not games or not cheats or not names:
+async def _tpl_preview(c: CallbackQuery, gidx: int, cidx: int, nidx: int):
+    found = _tpl_by_idx(c.from_user.id, gidx, cidx, nidx)
+    if not found:
         return await c.answer("Не найдено", show_alert=True)
-
-    game = games[gidx]
-    cheat = cheats[cidx]
-    name = names[nidx]
-    t = tpls_of(uid)[game][cheat][name]
+    _, _, _, t = found
     text = t.get("text", "")
     photo = t.get("photo")
-    buttons = t.get("buttons", [])
-    kb = matrix_to_markup(buttons)
+    kb = matrix_to_markup(t.get("buttons", []))
     if photo:
         await c.message.answer_photo(photo=photo, caption=text, reply_markup=kb)
     else:
         await c.message.answer(text, reply_markup=kb)
     await c.answer("Предпросмотр отправлен выше")
 
-@dp.callback_query(F.data.startswith("tpl:send#"))
-async def tpl_send(c: CallbackQuery):
+async def _tpl_send(c: CallbackQuery, gidx: int, cidx: int, nidx: int):
     uid = c.from_user.id
-    ch = storage.get("channels", {}).get(str(uid))
+    ch = channel_id_of(uid)
     if not ch:
         return await c.answer("⚠️ Сначала подключи свой канал в ⚙️ Настройках", show_alert=True)
-    try:
-        _, payload = c.data.split("#", 1)
-        gidx_s, cidx_s, nidx_s = payload.split("#")
-        gidx, cidx, nidx = int(gidx_s), int(cidx_s), int(nidx_s)
-    except Exception:
-        return await c.answer("Некорректные данные", show_alert=True)
-
-    games = list_games(uid)
-    cheats = list_cheats(uid, gidx)
-    names = list_names(uid, gidx, cidx)
-    if not games or not cheats or not names:
+    found = _tpl_by_idx(uid, gidx, cidx, nidx)
+    if not found:
         return await c.answer("Не найдено", show_alert=True)
-
-    game = games[gidx]
-    cheat = cheats[cidx]
-    name = names[nidx]
-    t = tpls_of(uid)[game][cheat][name]
+    game, cheat, name, t = found
     text = t.get("text", "")
     photo = t.get("photo")
-    buttons = t.get("buttons", [])
-    kb = matrix_to_markup(buttons)
+    kb = matrix_to_markup(t.get("buttons", []))
     try:
-        if photo:
-            await bot.send_photo(chat_id=ch, photo=photo, caption=text, reply_markup=kb)
-        else:
-            await bot.send_message(chat_id=ch, text=text, reply_markup=kb)
+        await _enqueue_send(ch, photo, text, kb)
         log_action(uid, f'Отправил шаблон "{game} / {cheat} / {name}" в свой канал')
         await c.answer("✅ Отправлено в твой канал!", show_alert=True)
     except Exception as e:
         await c.answer(f"❌ Ошибка: {e}", show_alert=True)
 
-@dp.callback_query(F.data.startswith("tpl:back:templates#"))
-async def back_to_templates(c: CallbackQuery):
-    try:
-        gidx = int(c.data.split("#")[1])
-        cidx = int(c.data.split("#")[2])
-    except Exception:
+_TPL_DISPATCH = {
+    "back:games": _tpl_show_games,
+    "g": _tpl_show_cheats,
+    "back:cheats": _tpl_show_cheats,
+    "c": _tpl_show_names,
+    "back:templates": _tpl_show_names,
+    "n": _tpl_show_template,
+    "prev": _tpl_preview,
+    "send": _tpl_send,
+}
+
+@dp.callback_query(F.data.startswith("tpl:"))
+async def tpl_router(c: CallbackQuery):
+    mt = _TPL_CB_RE.match(c.data or "")
+    if not mt:
         return await c.answer("Некорректные данные", show_alert=True)
-    await safe_edit_text(c.message, "💾 Выбери шаблон:", reply_markup=names_menu(c.from_user.id, gidx, cidx))
-    await c.answer()
+    kind, g, ch, n = mt.groups()
+    await _TPL_DISPATCH[kind](c, int(g) if g else 0, int(ch) if ch else 0, int(n) if n else 0)
 
 
 # ----------------------------- УПРАВЛЕНИЕ ШАБЛОНАМИ (персональные) ----------------------------- #
@@ -765,7 +1284,6 @@ async def manage_root(c: CallbackQuery):
     await safe_edit_text(c.message, "🧩 Управление шаблонами:", reply_markup=manage_menu())
     await c.answer()
 
-@dp.callback_query(F.data == "m:add")
 async def m_add_start(c: CallbackQuery, state: FSMContext):
     await state.set_state(ManageTemplateStates.ADD_GAME)
     await state.update_data(uid=c.from_user.id)
@@ -823,10 +1341,10 @@ async def m_btn_url(m: Message, state: FSMContext):
     if not (url.startswith("http://") or url.startswith("https://")):
         return await m.answer("❌ URL должен начинаться с http:// или https://")
     data = await state.get_data()
-    matrix = data.get("matrix", [])
-    row = data.get("row", [])
-    row.append({"t": data.get("btn_text"), "u": url})
-    await state.update_data(row=row, matrix=matrix)
+    # ряд/матрица в FSM — кортежи: append через новый кортеж, матрицу
+    # не перезаписываем в состояние, пока она не изменилась
+    row = tuple(data.get("row", ())) + ({"t": data.get("btn_text"), "u": url},)
+    await state.update_data(row=row)
 
     kb = InlineKeyboardBuilder()
     kb.button(text="➕ Ещё кнопка в ряд", callback_data="mt:add_in_row")
@@ -840,8 +1358,8 @@ async def m_btn_url(m: Message, state: FSMContext):
 @dp.callback_query(ManageTemplateStates.BTN_MENU, F.data.startswith("mt:"))
 async def m_btn_menu(c: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    row = data.get("row", [])
-    matrix = data.get("matrix", [])
+    row = tuple(data.get("row", ()))
+    matrix = tuple(data.get("matrix", ()))
 
     if c.data == "mt:add_in_row":
         await state.set_state(ManageTemplateStates.ADD_BTN_TEXT)
@@ -849,15 +1367,15 @@ async def m_btn_menu(c: CallbackQuery, state: FSMContext):
 
     elif c.data == "mt:new_row":
         if row:
-            matrix.append(row)
-            await state.update_data(matrix=matrix, row=[])
+            await state.update_data(matrix=matrix + (row,), row=())
         await state.set_state(ManageTemplateStates.ADD_BTN_TEXT)
         await safe_edit_text(c.message, "Текст первой кнопки в НОВЫЙ ряд:", reply_markup=back_menu_kb())
 
     elif c.data == "mt:save":
         if row:
-            matrix.append(row)
-        await finalize_template(state, matrix)
+            matrix = matrix + (row,)
+        # на диск — в прежней форме список списков
+        await finalize_template(state, [list(r) for r in matrix])
         await safe_edit_text(c.message, "✅ Шаблон сохранён.", reply_markup=manage_menu())
 
     await c.answer()
@@ -874,53 +1392,111 @@ async def finalize_template(state: FSMContext, matrix: List[List[Dict[str, str]]
         await state.clear()
         return
     tpls = tpls_of(uid)
-    tpls.setdefault(game, {}).setdefault(cheat, {})[name] = payload
-    save_storage(storage)
+    _tpl_insert(tpls, game, cheat, name, payload)
+    _flat_tpls[(uid, game, cheat, name)] = payload
+    _index_insert(uid, game, cheat, name)
+    _resort_user_tpls(uid)
+    _invalidate_tpl_cache(uid)
+    journal_append({"op": "tpl_set", "uid": uid, "path": [game, cheat, name], "val": payload})
     log_action(uid, f'Создал/обновил шаблон "{game} / {cheat} / {name}"')
     await state.clear()
 
 # удаление (пагинация)
 PAGE_SIZE = 20
-pending_deletes: Dict[int, List[Tuple[str, str, str]]] = {}
+
+# снапшоты списка удаления: кортеж (иммутабельный, индексы в callback_data
+# остаются валидными), LRU + TTL, чтобы брошенные сессии не жили вечно
+PENDING_TTL = 600.0
+PENDING_MAX = 256
+pending_deletes: "OrderedDict[int, Tuple[float, int, Tuple[Tuple[str, str, str], ...]]]" = OrderedDict()
+
+def _pending_snapshot(uid: int, refresh: bool = False) -> Tuple[Tuple[str, str, str], ...]:
+    now = time.monotonic()
+    gen = _tpl_gen.get(uid, 0)
+    entry = pending_deletes.get(uid)
+    if refresh or entry is None or entry[1] != gen or now - entry[0] > PENDING_TTL:
+        items = tuple(_collect_templates_flat(uid))
+    else:
+        items = entry[2]
+    pending_deletes[uid] = (now, gen, items)
+    pending_deletes.move_to_end(uid)
+    while len(pending_deletes) > PENDING_MAX:
+        pending_deletes.popitem(last=False)
+    return items
+
+# Отсортированный список (игра, чит, имя) на пользователя. Живёт между
+# кликами пагинации: мутации правят его через bisect за O(log N) вместо
+# полного обхода дерева на каждый m:delp:*.
+template_index: Dict[int, List[Tuple[str, str, str]]] = {}
 
 def _collect_templates_flat(uid: int) -> List[Tuple[str, str, str]]:
-    out: List[Tuple[str, str, str]] = []
-    tpls = tpls_of(uid)
-    for g, cheats in tpls.items():
-        for ch, names in cheats.items():
-            for n in names.keys():
-                out.append((g, ch, n))
-    return out
+    idx = template_index.get(uid)
+    if idx is None:
+        idx = template_index[uid] = sorted(
+            (g, ch, n)
+            for g, cheats in tpls_of(uid).items()
+            for ch, names in cheats.items()
+            for n in names.keys()
+        )
+    return idx
+
+# Поколение набора шаблонов пользователя: входит в ключи кэшей рендера,
+# так что после любой мутации старые записи просто перестают совпадать.
+_tpl_gen: Dict[int, int] = {}
+
+def _bump_tpl_gen(uid: int) -> None:
+    _tpl_gen[uid] = _tpl_gen.get(uid, 0) + 1
+
+def _index_insert(uid: int, g: str, ch: str, n: str) -> None:
+    idx = _collect_templates_flat(uid)
+    key = (g, ch, n)
+    pos = bisect.bisect_left(idx, key)
+    if pos == len(idx) or idx[pos] != key:
+        idx.insert(pos, key)
+        _bump_tpl_gen(uid)
+
+def _index_remove(uid: int, g: str, ch: str, n: str) -> None:
+    idx = template_index.get(uid)
+    if idx is None:
+        return
+    key = (g, ch, n)
+    pos = bisect.bisect_left(idx, key)
+    if pos < len(idx) and idx[pos] == key:
+        del idx[pos]
+        _bump_tpl_gen(uid)
 
 def _delete_menu_page(user_id: int, page: int) -> InlineKeyboardMarkup:
-    items = pending_deletes.get(user_id, [])
+    return _delete_menu_markup(user_id, page, _tpl_gen.get(user_id, 0))
+
+@lru_cache(maxsize=128)
+def _delete_menu_markup(user_id: int, page: int, gen: int) -> InlineKeyboardMarkup:
+    entry = pending_deletes.get(user_id)
+    items = entry[2] if entry is not None else ()
     total = len(items)
     max_page = max(0, (total - 1) // PAGE_SIZE) if total else 0
     page = max(0, min(page, max_page))
     start = page * PAGE_SIZE
     end = min(start + PAGE_SIZE, total)
-    kb = InlineKeyboardBuilder()
-    for idx in range(start, end):
-        g, ch, n = items[idx]
-        kb.button(text=f"{g} / {ch} / {n}"[:64], callback_data=f"m:delete:{idx}")
-    nav = InlineKeyboardBuilder()
+    # собираем InlineKeyboardMarkup напрямую, без трёх Builder'ов
+    # с их adjust/export-проходами на каждый клик
+    rows = [
+        [InlineKeyboardButton(text=f"{g} / {ch} / {n}"[:64], callback_data=f"m:delete:{idx}")]
+        for idx, (g, ch, n) in enumerate(items[start:end], start=start)
+    ]
+    nav = []
     if page > 0:
-        nav.button(text="⬅️ Назад", callback_data=f"m:delp:{page-1}")
-    nav.button(text=f"Стр. {page+1}/{max_page+1 if total else 1}", callback_data="noop")
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"m:delp:{page-1}"))
+    nav.append(InlineKeyboardButton(text=f"Стр. {page+1}/{max_page+1 if total else 1}", callback_data="noop"))
     if page < max_page:
-        nav.button(text="Вперёд ➡️", callback_data=f"m:delp:{page+1}")
-    exit_kb = InlineKeyboardBuilder()
-    exit_kb.button(text="🏁 Выйти", callback_data="menu:manage")
-    kb.adjust(1); nav.adjust(3); exit_kb.adjust(1)
-    full = InlineKeyboardMarkup(inline_keyboard=[*kb.export(), *nav.export(), *exit_kb.export()])
-    return full
-
-@dp.callback_query(F.data == "m:del")
+        nav.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"m:delp:{page+1}"))
+    rows.append(nav)
+    rows.append([InlineKeyboardButton(text="🏁 Выйти", callback_data="menu:manage")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
 async def delete_template_start(c: CallbackQuery):
-    items = _collect_templates_flat(c.from_user.id)
+    items = _pending_snapshot(c.from_user.id, refresh=True)
     if not items:
         return await c.answer("📂 Нет сохранённых шаблонов", show_alert=True)
-    pending_deletes[c.from_user.id] = items
     await safe_edit_text(
         c.message,
         f"🗑 Выбери шаблон для удаления:\nВсего: <b>{len(items)}</b>",
@@ -928,24 +1504,21 @@ async def delete_template_start(c: CallbackQuery):
     )
     await c.answer()
 
-@dp.callback_query(F.data.startswith("m:delp:"))
 async def delete_template_page(c: CallbackQuery):
     try:
         page = int(c.data.split(":")[2])
     except Exception:
         page = 0
-    if c.from_user.id not in pending_deletes:
-        pending_deletes[c.from_user.id] = _collect_templates_flat(c.from_user.id)
+    items = _pending_snapshot(c.from_user.id)
     await safe_edit_text(
         c.message,
-        f"🗑 Выбери шаблон для удаления:\nВсего: <b>{len(pending_deletes[c.from_user.id])}</b>",
+        f"🗑 Выбери шаблон для удаления:\nВсего: <b>{len(items)}</b>",
         reply_markup=_delete_menu_page(c.from_user.id, page=page)
     )
     await c.answer()
 
-@dp.callback_query(F.data.startswith("m:delete:"))
 async def delete_template_confirm(c: CallbackQuery):
-    items = pending_deletes.get(c.from_user.id, [])
+    items = _pending_snapshot(c.from_user.id)
     try:
         idx = int(c.data.split(":")[2])
     except Exception:
@@ -954,18 +1527,21 @@ async def delete_template_confirm(c: CallbackQuery):
         return await c.answer("❌ Элемент не найден (возможно список изменился)", show_alert=True)
     uid = c.from_user.id
     g, ch, n = items[idx]
-    try:
-        del tpls_of(uid)[g][ch][n]
-        if not tpls_of(uid)[g][ch]:
-            del tpls_of(uid)[g][ch]
-        if not tpls_of(uid)[g]:
-            del tpls_of(uid)[g]
-        save_storage(storage)
+    # локальные ссылки + pop вместо каскада del с повторным tpls_of на каждом шаге
+    tpls = tpls_of(uid)
+    gmap = tpls.get(g)
+    chmap = gmap.get(ch) if gmap is not None else None
+    if chmap is not None and chmap.pop(n, None) is not None:
+        if not chmap:
+            gmap.pop(ch, None)
+        if not gmap:
+            tpls.pop(g, None)
+        _flat_tpls.pop((uid, g, ch, n), None)
+        _index_remove(uid, g, ch, n)
+        _invalidate_tpl_cache(uid)
+        journal_append({"op": "tpl_del", "uid": uid, "path": [g, ch, n]})
         log_action(uid, f'Удалил шаблон "{g} / {ch} / {n}"')
-    except KeyError:
-        pass
-    items = _collect_templates_flat(uid)
-    pending_deletes[uid] = items
+    items = _pending_snapshot(uid, refresh=True)
     await c.answer("✅ Шаблон удалён", show_alert=True)
     page = (idx // PAGE_SIZE) if items else 0
     max_page = max(0, (max(len(items), 1) - 1) // PAGE_SIZE)
@@ -976,20 +1552,28 @@ async def delete_template_confirm(c: CallbackQuery):
         reply_markup=_delete_menu_page(uid, page=page)
     )
 
-@dp.callback_query(F.data == "m:list")
+# готовый текст списка шаблонов: (поколение, body) на пользователя
+_list_cache: Dict[int, Tuple[int, str]] = {}
+
 async def list_templates(c: CallbackQuery):
     uid = c.from_user.id
     tpls = tpls_of(uid)
     if not tpls:
         return await c.answer("📂 Нет сохранённых шаблонов", show_alert=True)
 
-    lines = []
-    for game in sorted(tpls.keys(), key=str.lower):
-        for cheat in sorted(tpls[game].keys(), key=str.lower):
-            names = sorted(tpls[game][cheat].keys(), key=str.lower)
-            lines.append(f"{game} -> {cheat} -> {', '.join(names)}")
-
-    body = "\n".join(lines)
+    gen = _tpl_gen.get(uid, 0)
+    cached = _list_cache.get(uid)
+    if cached is not None and cached[0] == gen:
+        body = cached[1]
+    else:
+        # дерево уже отсортировано на записи (_resort_user_tpls) — один проход
+        # без повторных sorted() на каждом уровне
+        body = "\n".join(
+            f"{game} -> {cheat} -> {', '.join(names.keys())}"
+            for game, cheats in tpls.items()
+            for cheat, names in cheats.items()
+        )
+        _list_cache[uid] = (gen, body)
     text = "📜 <b>Список шаблонов</b>\n\n" + html.escape(body)
 
     if len(text) > 3500:
@@ -1001,17 +1585,15 @@ async def list_templates(c: CallbackQuery):
     await c.answer()
 
 # Экспорт / Импорт
-@dp.callback_query(F.data == "m:export")
 async def m_export(c: CallbackQuery):
     if not admin_only(c.from_user.id):
         return await c.answer("⛔️ Доступ только для админов.", show_alert=True)
-    payload = json.dumps(tpls_of(c.from_user.id), ensure_ascii=False, indent=2).encode("utf-8")
+    payload = _json_dumps_pretty(tpls_of(c.from_user.id))
     doc = BufferedInputFile(payload, filename="templates_export.json")
     await c.message.answer_document(document=doc, caption="📦 Экспорт твоих шаблонов (JSON).")
     log_action(c.from_user.id, "Экспортировал свои шаблоны")
     await c.answer()
 
-@dp.callback_query(F.data == "m:import")
 async def m_import_start(c: CallbackQuery, state: FSMContext):
     if not admin_only(c.from_user.id):
         return await c.answer("⛔️ Доступ только для админов.", show_alert=True)
@@ -1019,43 +1601,61 @@ async def m_import_start(c: CallbackQuery, state: FSMContext):
     await c.message.answer("📥 Пришли файл <b>templates_export.json</b> (как документ).")
     await c.answer()
 
+def _iter_import(incoming: dict):
+    # один EAFP-проход по дереву импорта: не-словарь на любом уровне
+    # просто пропускаем, без isinstance на каждый шаблон
+    for game, cheats in incoming.items():
+        try:
+            cheat_items = cheats.items()
+        except AttributeError:
+            continue
+        for cheat, names in cheat_items:
+            try:
+                name_items = names.items()
+            except AttributeError:
+                continue
+            for name, payload in name_items:
+                try:
+                    yield game, cheat, name, {
+                        'text': payload.get('text', ''),
+                        'photo': payload.get('photo'),
+                        'buttons': payload.get('buttons', []),
+                    }
+                except AttributeError:
+                    continue
+
 @dp.message(ImportTemplatesStates.WAIT_FILE, F.document)
 async def m_import_file(m: Message, state: FSMContext):
     if not admin_only(m.from_user.id):
         return await m.answer("⛔️ Доступ только для админов.")
     try:
-        buf = BytesIO()
-        await bot.download(m.document, destination=buf)
-        buf.seek(0)
-        incoming = json.load(buf)
-        if not isinstance(incoming, dict):
+        # без промежуточного BytesIO: download отдаёт готовый буфер,
+        # парсим его байты напрямую
+        raw = await bot.download(m.document)
+        incoming = _json_loads(raw.read())
+        # json/orjson отдают ровно dict, подклассов не бывает — точная
+        # проверка типа дешевле isinstance с обходом MRO
+        if type(incoming) is not dict:
             return await m.answer("❌ Неверный формат: нужен объект {game: {cheat: {name: {...}}}}")
 
         merged = 0
-        tpls = tpls_of(m.from_user.id)
-        for game, cheats in incoming.items():
-            if not isinstance(cheats, dict):
-                continue
-            g = tpls.setdefault(game, {})
-            for cheat, names in cheats.items():
-                if not isinstance(names, dict):
+        uid = m.from_user.id
+        tpls = tpls_of(uid)
+        with buffered_storage():
+            for game, cheat, name, new_payload in _iter_import(incoming):
+                fp = template_fingerprint(new_payload)
+                if has_duplicate_template(uid, fp):
                     continue
-                ch = g.setdefault(cheat, {})
-                for name, payload in names.items():
-                    if not isinstance(payload, dict):
-                        continue
-                    text = payload.get('text', '')
-                    photo = payload.get('photo')
-                    buttons = payload.get('buttons', [])
-                    new_payload = {'text': text, 'photo': photo, 'buttons': buttons}
-                    fp = template_fingerprint(new_payload)
-                    if has_duplicate_template(m.from_user.id, fp):
-                        continue
-                    ch[name] = new_payload
-                    merged += 1
-
-        save_storage(storage)
-        log_action(m.from_user.id, f"Импортировал шаблоны (штук: {merged})")
+                _tpl_insert(tpls, game, cheat, name, new_payload)
+                _flat_tpls[(uid, game, cheat, name)] = new_payload
+                _index_insert(uid, game, cheat, name)
+                merged += 1
+
+            if merged:
+                _resort_user_tpls(uid)
+                _invalidate_tpl_cache(uid)
+                mark_dirty()  # пустой импорт (одни дубликаты) файл не трогает
+        log_action(uid, f"Импортировал шаблоны (штук: {merged})")
         await state.clear()
         await m.answer(f"✅ Импорт завершён. Шаблонов добавлено/обновлено: <b>{merged}</b>.")
     except Exception as e:
@@ -1065,6 +1665,31 @@ async def m_import_file(m: Message, state: FSMContext):
 async def m_import_wrong(m: Message):
     await m.answer("Пришли файл-документ JSON (templates_export.json).")
 
+# Один роутер на все m:* — как tpl_router: один startswith + словарь
+# вместо цепочки отдельных фильтров на каждый callback.
+_M_DISPATCH = {
+    "del": delete_template_start,
+    "delp": delete_template_page,
+    "delete": delete_template_confirm,
+    "list": list_templates,
+    "export": m_export,
+}
+_M_DISPATCH_FSM = {
+    "add": m_add_start,
+    "import": m_import_start,
+}
+
+@dp.callback_query(F.data.startswith("m:"))
+async def m_router(c: CallbackQuery, state: FSMContext):
+    kind = (c.data or "").split(":", 2)[1]
+    handler = _M_DISPATCH.get(kind)
+    if handler is not None:
+        return await handler(c)
+    handler = _M_DISPATCH_FSM.get(kind)
+    if handler is not None:
+        return await handler(c, state)
+    await c.answer("Некорректные данные", show_alert=True)
+
 
 # ----------------------------- НАСТРОЙКИ: канал и роли ----------------------------- #
 
@@ -1074,36 +1699,44 @@ async def settings_root(c: CallbackQuery, state: FSMContext):
     await safe_edit_text(c.message, "⚙️ Настройки:", reply_markup=settings_menu_kb(c.from_user.id))
     await c.answer()
 
-@dp.callback_query(F.data == "set:clear")
 async def set_clear(c: CallbackQuery):
-    key = str(c.from_user.id)
-    storage.setdefault("channels", {}).pop(key, None)
-    storage.setdefault("channel_titles", {}).pop(key, None)
-    save_storage(storage)
-    log_action(c.from_user.id, "Отвязал свой канал")
+    uid = c.from_user.id
+    entry = _channel_by_user.pop(uid, None)
+    if entry is not None:
+        # отвязанный канал не должен отдаваться из кэшей get_chat
+        _chat_cache.pop(entry["id"], None)
+        _channel_display_cache.pop(entry["id"], None)
+        # повторный клик по «Очистить» не переписывает файл зря
+        journal_append({"op": "clear_channel", "uid": uid})
+        log_action(c.from_user.id, "Отвязал свой канал")
     await safe_edit_text(c.message, "Канал очищен.", reply_markup=settings_menu_kb(c.from_user.id))
     await c.answer()
 
-@dp.callback_query(F.data == "set:test")
 async def set_test(c: CallbackQuery):
-    ch = storage.get("channels", {}).get(str(c.from_user.id))
+    ch = channel_id_of(c.from_user.id)
     if not ch:
         return await c.answer("Канал не подключён", show_alert=True)
     try:
-        await bot.send_message(ch, "🧪 Тест: бот может отправлять сообщения в канал.")
+        await _enqueue_send(ch, None, "🧪 Тест: бот может отправлять сообщения в канал.", None)
         await c.answer("✅ Тест отправлен. Если не видишь — назначь бота админом в канале.", show_alert=True)
     except Exception as e:
         await c.answer(f"❌ Ошибка: {e}", show_alert=True)
 
-@dp.callback_query(F.data == "set:connect")
-async def set_connect(c: CallbackQuery, state: FSMContext):
-    await state.set_state(SettingsStates.CHOOSE_CONNECT_METHOD)
+# Выбор способа подключения не зависит от состояния — один markup на всех,
+# как _BACK_MENU_KB
+def _build_connect_method_kb() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.button(text="➡️ Перешлите пост из канала", callback_data="set:via_forward")
     kb.button(text="✏️ Указать @username", callback_data="set:via_username")
     kb.button(text="⬅️ В настройки", callback_data="menu:settings")
     kb.adjust(1, 1, 1)
-    await safe_edit_text(c.message, "Как подключить канал?", reply_markup=kb.as_markup())
+    return kb.as_markup()
+
+_CONNECT_METHOD_KB = _build_connect_method_kb()
+
+async def set_connect(c: CallbackQuery, state: FSMContext):
+    await state.set_state(SettingsStates.CHOOSE_CONNECT_METHOD)
+    await safe_edit_text(c.message, "Как подключить канал?", reply_markup=_CONNECT_METHOD_KB)
     await c.answer()
 
 @dp.callback_query(SettingsStates.CHOOSE_CONNECT_METHOD, F.data == "set:via_forward")
@@ -1119,23 +1752,21 @@ async def connect_via_forward(c: CallbackQuery, state: FSMContext):
 @dp.message(SettingsStates.WAIT_FORWARD_FROM_CHANNEL)
 async def get_channel_from_forward(m: Message, state: FSMContext):
     if m.forward_from_chat and m.forward_from_chat.type == ChatType.CHANNEL:
-        key = str(m.from_user.id)
+        key = m.from_user.id
         ch_id = m.forward_from_chat.id
         title = (m.forward_from_chat.title or "Канал").strip()
         label = f"{title} ({ch_id})"
         # чекер: пользователь должен быть админом канала
-        if not await user_is_admin(ch_id, m.from_user.id):
+        user_ok, bot_ok = await _channel_admin_flags(ch_id, m.from_user.id)
+        if not user_ok:
             return await m.answer("⛔️ Ты не админ этого канала — подключение запрещено.", reply_markup=back_menu_kb())
-        storage.setdefault("channels", {})[key] = ch_id
-        storage.setdefault("channel_titles", {})[key] = label
-        save_storage(storage)
+        _channel_by_user[key] = {"id": ch_id, "title": label}
+        journal_append({"op": "set_channel", "uid": m.from_user.id, "id": ch_id, "title": label})
         log_action(m.from_user.id, f'Подключил канал "{title}" ({ch_id})')
         await state.clear()
-        warn = ""
-        if not await bot_is_admin(ch_id):
-            warn = "\n⚠️ Бот не админ в канале — выдайте права, чтобы постить."
+        warn = "" if bot_ok else "\n⚠️ Бот не админ в канале — выдайте права, чтобы постить."
         await m.answer(
-            f"✅ Канал подключён: <b>{html.escape(title)}</b> (<code>{ch_id}</code>){warn}",
+            f"✅ Канал подключён: <b>{_esc(title)}</b> (<code>{ch_id}</code>){warn}",
             reply_markup=settings_menu_kb(m.from_user.id)
         )
     else:
@@ -1151,31 +1782,34 @@ async def connect_via_username(c: CallbackQuery, state: FSMContext):
     )
     await c.answer()
 
+# Формат @username у Telegram: 5-32 символа [A-Za-z0-9_]. Один match
+# вместо strip+startswith валидирует и отсекает мусор до похода в get_chat.
+_USERNAME_RE = re.compile(r"^\s*(@[A-Za-z0-9_]{5,32})\s*$")
+
 @dp.message(SettingsStates.WAIT_CHANNEL_USERNAME)
 async def get_channel_from_username(m: Message, state: FSMContext):
-    username = (m.text or "").strip()
-    if not username.startswith("@"):
+    match = _USERNAME_RE.match(m.text or "")
+    if not match:
         return await m.answer("Нужен формат @username", reply_markup=back_menu_kb())
+    username = match.group(1)
     try:
         chat: Chat = await bot.get_chat(username)
         if chat.type != ChatType.CHANNEL:
             return await m.answer("Это не канал. Укажи @username именно канала.", reply_markup=back_menu_kb())
-        key = str(m.from_user.id)
+        key = m.from_user.id
         ch_id = chat.id
         title = (chat.title or "Канал").strip()
         label = f"{title} ({ch_id})"
-        if not await user_is_admin(ch_id, m.from_user.id):
+        user_ok, bot_ok = await _channel_admin_flags(ch_id, m.from_user.id)
+        if not user_ok:
             return await m.answer("⛔️ Ты не админ этого канала — подключение запрещено.", reply_markup=back_menu_kb())
-        storage.setdefault("channels", {})[key] = ch_id
-        storage.setdefault("channel_titles", {})[key] = label
-        save_storage(storage)
+        _channel_by_user[key] = {"id": ch_id, "title": label}
+        journal_append({"op": "set_channel", "uid": m.from_user.id, "id": ch_id, "title": label})
         log_action(m.from_user.id, f'Подключил канал "{title}" ({ch_id}) через @username')
         await state.clear()
-        warn = ""
-        if not await bot_is_admin(ch_id):
-            warn = "\n⚠️ Бот не админ в канале — выдайте права, чтобы постить."
+        warn = "" if bot_ok else "\n⚠️ Бот не админ в канале — выдайте права, чтобы постить."
         await m.answer(
-            f"✅ Канал подключён: <b>{html.escape(title)}</b> (<code>{ch_id}</code>){warn}",
+            f"✅ Канал подключён: <b>{_esc(title)}</b> (<code>{ch_id}</code>){warn}",
             reply_markup=settings_menu_kb(m.from_user.id)
         )
     except Exception as e:
@@ -1184,37 +1818,43 @@ async def get_channel_from_username(m: Message, state: FSMContext):
 
 # ----------------------------- ВЛАДЕЛЕЦ: ПАНЕЛЬ и АУДИТ ----------------------------- #
 
+# статичная «обвязка» сообщений панели
+PANEL_HDR = "👥 <b>Админы и их каналы</b>\n"
+ADMINS_HDR = "📜 <b>Админы</b>\n"
+
+_user_display_cache: Dict[int, Tuple[float, str]] = {}
+
 async def get_user_display_for_panel(uid: int) -> str:
+    cached = _user_display_cache.get(uid)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < DISPLAY_CACHE_TTL:
+        return cached[1]
     try:
-        chat: Chat = await bot.get_chat(uid)
-        name = html.escape(chat.full_name or str(uid))
+        chat: Chat = await cached_get_chat(uid)
+        name = _esc(chat.full_name or str(uid))
         if chat.username:
-            return f'<a href="https://t.me/{chat.username}">{name}</a>'
-        return f'<a href="tg://user?id={uid}">{name}</a>'
+            out = f'<a href="https://t.me/{chat.username}">{name}</a>'
+        else:
+            out = f'<a href="tg://user?id={uid}">{name}</a>'
     except Exception:
-        return f'<a href="tg://user?id={uid}">{uid}</a>'
-
-@dp.callback_query(F.data == "owner:panel")
-async def owner_panel(c: CallbackQuery):
-    if not is_owner(c.from_user.id):
-        return await c.answer("Только для владельца", show_alert=True)
+        out = f'<a href="tg://user?id={uid}">{uid}</a>'
+    _user_display_cache[uid] = (now, out)
+    return out
 
-    admins = storage.get("admins", [])
-    channels = storage.get("channels", {})
-
-    lines: List[str] = []
-    for uid in admins:
-        user_html = await get_user_display_for_panel(uid)
-        tag = " (OWNER)" if uid == OWNER_ID else ""
-        ch_id = channels.get(str(uid))
-        if ch_id:
-            ch_html = await get_channel_display(ch_id)
-            lines.append(f"• {user_html}{tag} — {ch_html}")
-        else:
-            lines.append(f"• {user_html}{tag} — канал не подключён")
+async def _admin_line(uid: int, ch_id: Optional[int]) -> str:
+    user_html = await get_user_display_for_panel(uid)
+    tag = " (OWNER)" if uid == OWNER_ID else ""
+    if ch_id:
+        return f"• {user_html}{tag} — {await get_channel_display(ch_id)}"
+    return f"• {user_html}{tag} — канал не подключён"
 
-    text = "👥 <b>Админы и их каналы</b>\n" + ("\n".join(lines) if lines else "пусто")
+async def _admin_panel_lines() -> List[str]:
+    # все get_chat уходят параллельно: K последовательных RTT -> один
+    admins = sorted(_admins_set)
+    return list(await asyncio.gather(*(_admin_line(uid, channel_id_of(uid)) for uid in admins)))
 
+# Кнопки панели владельца статичны — строим markup один раз
+def _build_owner_panel_kb() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.button(text="👤 Добавить админа", callback_data="set:add_admin")
     kb.button(text="🗑 Удалить админа", callback_data="set:del_admin")
@@ -1222,14 +1862,23 @@ async def owner_panel(c: CallbackQuery):
     kb.button(text="🧾 Аудит-лог", callback_data="owner:audit")  # NEW
     kb.button(text="⬅️ В меню", callback_data="menu:back")
     kb.adjust(2, 2, 1, 1)
-    await safe_edit_text(c.message, text, reply_markup=kb.as_markup())
+    return kb.as_markup()
+
+_OWNER_PANEL_KB = _build_owner_panel_kb()
+
+async def owner_panel(c: CallbackQuery):
+    if not is_owner(c.from_user.id):
+        return await c.answer("Только для владельца", show_alert=True)
+
+    lines = await _admin_panel_lines()
+    text = PANEL_HDR + ("\n".join(lines) or "пусто")
+    await safe_edit_text(c.message, text, reply_markup=_OWNER_PANEL_KB)
     await c.answer()
 
-@dp.callback_query(F.data == "owner:audit")
 async def owner_audit(c: CallbackQuery):
     if not is_owner(c.from_user.id):
         return await c.answer("Только для владельца", show_alert=True)
-    lines = tail_audit(20)
+    lines = list(_audit_tail)[-20:]
     if not lines:
         return await c.message.answer("🧾 Лог пуст.")
     body = "\n".join(lines)
@@ -1241,7 +1890,6 @@ async def owner_audit(c: CallbackQuery):
         await c.message.answer(f"🧾 <b>Последние 20 действий</b>\n<pre>{html.escape(body)}</pre>")
     await c.answer()
 
-@dp.callback_query(F.data == "set:add_admin")
 async def set_add_admin(c: CallbackQuery, state: FSMContext):
     if not is_owner(c.from_user.id):
         return await c.answer("Только для владельца", show_alert=True)
@@ -1257,15 +1905,14 @@ async def add_admin(m: Message, state: FSMContext):
         uid = int((m.text or "").strip())
     except ValueError:
         return await m.answer("Нужно число. Пришли user_id снова.", reply_markup=back_menu_kb())
-    admins = set(storage.get("admins", []))
-    admins.add(uid)
-    storage["admins"] = sorted(list(admins))
-    save_storage(storage)
+    _admins_set.add(uid)
+    _user_display_cache.pop(uid, None)
+    mark_dirty()  # сбросить кэш превью /storage
+    await save_storage_async(storage, durable=True)
     log_action(m.from_user.id, f"Добавил админа {uid}")
     await state.clear()
     await m.answer("✅ Админ добавлен.", reply_markup=main_menu_kb(m.from_user.id))
 
-@dp.callback_query(F.data == "set:del_admin")
 async def set_del_admin(c: CallbackQuery, state: FSMContext):
     if not is_owner(c.from_user.id):
         return await c.answer("Только для владельца", show_alert=True)
@@ -1283,11 +1930,11 @@ async def del_admin(m: Message, state: FSMContext):
         uid = int((m.text or "").strip())
     except ValueError:
         return await m.answer("Нужно число. Пришли user_id снова.", reply_markup=back_menu_kb())
-    admins = set(storage.get("admins", []))
-    if uid in admins:
-        admins.remove(uid)
-        storage["admins"] = sorted(list(admins))
-        save_storage(storage)
+    if uid in _admins_set:
+        _admins_set.remove(uid)
+        _user_display_cache.pop(uid, None)
+        mark_dirty()  # сбросить кэш превью /storage
+        await save_storage_async(storage, durable=True)
         log_action(m.from_user.id, f"Удалил админа {uid}")
         msg = "🗑 Админ удалён."
     else:
@@ -1295,29 +1942,51 @@ async def del_admin(m: Message, state: FSMContext):
     await state.clear()
     await m.answer(msg, reply_markup=main_menu_kb(m.from_user.id))
 
-@dp.callback_query(F.data == "set:list_admins")
 async def list_admins(c: CallbackQuery):
     if not is_owner(c.from_user.id):
         return await c.answer("Только для владельца", show_alert=True)
 
-    admins = storage.get("admins", [])
-    channels = storage.get("channels", {})
-
-    lines: List[str] = []
-    for uid in admins:
-        user_html = await get_user_display_for_panel(uid)
-        tag = " (OWNER)" if uid == OWNER_ID else ""
-        ch_id = channels.get(str(uid))
-        if ch_id:
-            ch_html = await get_channel_display(ch_id)
-            lines.append(f"• {user_html}{tag} — {ch_html}")
-        else:
-            lines.append(f"• {user_html}{tag} — канал не подключён")
-
-    txt = "📜 <b>Админы</b>\n" + ("\n".join(lines) if lines else "пусто")
+    lines = await _admin_panel_lines()
+    txt = ADMINS_HDR + ("\n".join(lines) or "пусто")
     await c.message.answer(txt, disable_web_page_preview=True)
     await c.answer()
 
+# Роутеры set:* и owner:* — как m_router: один фильтр по префиксу и словарь
+# вместо отдельной проверки F.data == ... на каждый клик. Хэндлеры с
+# state-фильтром (set:via_*) зарегистрированы выше и срабатывают раньше.
+_SET_DISPATCH = {
+    "clear": set_clear,
+    "test": set_test,
+    "list_admins": list_admins,
+}
+_SET_DISPATCH_FSM = {
+    "connect": set_connect,
+    "add_admin": set_add_admin,
+    "del_admin": set_del_admin,
+}
+_OWNER_DISPATCH = {
+    "panel": owner_panel,
+    "audit": owner_audit,
+}
+
+@dp.callback_query(F.data.startswith("set:"))
+async def set_router(c: CallbackQuery, state: FSMContext):
+    kind = (c.data or "").split(":", 1)[1]
+    handler = _SET_DISPATCH.get(kind)
+    if handler is not None:
+        return await handler(c)
+    handler = _SET_DISPATCH_FSM.get(kind)
+    if handler is not None:
+        return await handler(c, state)
+    await c.answer("Некорректные данные", show_alert=True)
+
+@dp.callback_query(F.data.startswith("owner:"))
+async def owner_router(c: CallbackQuery):
+    handler = _OWNER_DISPATCH.get((c.data or "").split(":", 1)[1])
+    if handler is not None:
+        return await handler(c)
+    await c.answer("Некорректные данные", show_alert=True)
+
 
 # ----------------------------- ЗАПУСК ----------------------------- #
 
@@ -1330,6 +1999,13 @@ async def main():
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
+    # uvloop (если установлен) заметно ускоряет цикл событий; без него
+    # работаем на штатном asyncio — на Windows uvloop недоступен
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):